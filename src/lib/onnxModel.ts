@@ -32,10 +32,32 @@ export async function loadOnnxModel(): Promise<void> {
   }
 }
 
+// App form values -> category strings in heart_disease_uci.csv. The exported OrdinalEncoder maps
+// anything outside the training vocabulary to -1, which the trees read as the first category.
+// Values already in the training vocabulary pass through unchanged.
+const SEX_CATEGORIES: Record<string, string> = { M: 'Male', F: 'Female' };
+const CHEST_PAIN_CATEGORIES: Record<string, string> = {
+  typical_angina: 'typical angina',
+  atypical_angina: 'atypical angina',
+  non_anginal_pain: 'non-anginal',
+};
+const RESTING_ECG_CATEGORIES: Record<string, string> = {
+  st_t_abnormality: 'st-t abnormality',
+  lvh: 'lv hypertrophy',
+};
+const THAL_CATEGORIES: Record<string, string> = {
+  fixed_defect: 'fixed defect',
+  reversible_defect: 'reversible defect',
+};
+
+function toTrainingCategory(categories: Record<string, string>, value: string): string {
+  return categories[value] ?? value;
+}
+
 /**
  * Convert patient data to model input format matching scikit-learn pipeline
- * The ONNX model was exported with to_onnx(pipeline, dataframe_sample)
- * It expects 13 separate named inputs with specific types matching the training data
+ * The ONNX model was exported with convert_sklearn(pipeline, initial_types=...)
+ * It expects 13 separate named [N, 1] inputs: strings for categoricals, float64 for the rest
  */
 function prepareOnnxInput(patient: PatientData): Record<string, ort.Tensor> {
   // CATEGORICAL_COLS = ["sex", "cp", "restecg", "slope", "thal"] - exported as object (strings)
@@ -44,11 +66,11 @@ function prepareOnnxInput(patient: PatientData): Record<string, ort.Tensor> {
   
   const inputs: Record<string, ort.Tensor> = {
     // Categorical features - strings (object dtype in pandas)
-    'sex': new ort.Tensor('string', [patient.sex], [1, 1]),
-    'cp': new ort.Tensor('string', [patient.chestPainType], [1, 1]),
-    'restecg': new ort.Tensor('string', [patient.restingECG], [1, 1]),
+    'sex': new ort.Tensor('string', [toTrainingCategory(SEX_CATEGORIES, patient.sex)], [1, 1]),
+    'cp': new ort.Tensor('string', [toTrainingCategory(CHEST_PAIN_CATEGORIES, patient.chestPainType)], [1, 1]),
+    'restecg': new ort.Tensor('string', [toTrainingCategory(RESTING_ECG_CATEGORIES, patient.restingECG)], [1, 1]),
     'slope': new ort.Tensor('string', [patient.stSlope], [1, 1]),
-    'thal': new ort.Tensor('string', [patient.thal || 'normal'], [1, 1]),
+    'thal': new ort.Tensor('string', [toTrainingCategory(THAL_CATEGORIES, patient.thal || 'normal')], [1, 1]),
     
     // Boolean features - float (not string!)
     'fbs': new ort.Tensor('float64', new Float64Array([patient.fastingBloodSugar ? 1.0 : 0.0]), [1, 1]),
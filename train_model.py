@@ -1,27 +1,26 @@
 #!/usr/bin/env python3
 """
 Train XGBoost model on UCI Heart Disease dataset and export to ONNX format.
-Install dependencies: pip install xgboost sklearn-onnx onnx pandas scikit-learn
+Install dependencies: pip install xgboost skl2onnx onnxmltools onnx pandas pyarrow scikit-learn
 """
 
+from pathlib import Path
+
 import pandas as pd
 import numpy as np
 from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import LabelEncoder
 import xgboost as xgb
 import skl2onnx
 from skl2onnx.common.data_types import FloatTensorType
+from skl2onnx.common.shape_calculator import calculate_linear_classifier_output_shapes
+from onnxmltools.convert.xgboost.operator_converters.XGBoost import convert_xgboost
 import onnx
 
+DATA_PATH = Path(__file__).resolve().parent / 'public' / 'data' / 'heart_disease_uci.csv'
+
 # Load UCI Heart Disease dataset
 print("Loading UCI Heart Disease dataset...")
-url = "https://raw.githubusercontent.com/uci-ml-repo/uci-ml-repo.github.io/master/datasets/heart_disease/heart_disease.csv"
-
-try:
-    df = pd.read_csv(url)
-except:
-    print("Error: Could not download dataset. Using local path...")
-    df = pd.read_csv('public/data/heart_disease_uci.csv')
+df = pd.read_csv(DATA_PATH, engine='pyarrow')
 
 print(f"Dataset shape: {df.shape}")
 print(f"Columns: {df.columns.tolist()}")
@@ -53,24 +52,22 @@ y = (df['num'] > 0).astype(int)  # Binary: disease present (1) or not (0)
 print(f"\nFeatures shape: {X.shape}")
 print(f"Target distribution: {y.value_counts().to_dict()}")
 
-# Handle missing values
-X = X.fillna(X.mean())
-
-# Encode categorical features
-le_sex = LabelEncoder()
-le_cp = LabelEncoder()
-le_restecg = LabelEncoder()
-le_slope = LabelEncoder()
+# Handle missing values (numeric means; missing booleans count as False)
+X = X.fillna(X.mean(numeric_only=True))
+for col in ['fbs', 'exang']:
+    X[col] = X[col].eq(True).astype(np.int8)
 
-X['sex'] = le_sex.fit_transform(X['sex'].astype(str))
-X['cp'] = le_cp.fit_transform(X['cp'].astype(str))
-X['restecg'] = le_restecg.fit_transform(X['restecg'].astype(str))
-X['slope'] = le_slope.fit_transform(X['slope'].astype(str))
+# Encode categorical features (sorted category codes, same mapping LabelEncoder would give)
+for col in ['sex', 'cp', 'restecg', 'slope']:
+    X[col] = X[col].astype(str).astype('category').cat.codes.astype(np.int8)
 
 print(f"\nProcessed features:\n{X.head()}")
 
-# Split data
-X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
+# Split data. A plain float32 array: it matches the precision the exported ONNX tree ensemble
+# compares inputs in, and the onnxmltools converter needs the default f0..fN feature names
+X_train, X_test, y_train, y_test = train_test_split(
+    X.to_numpy(dtype=np.float32), y, test_size=0.2, random_state=42
+)
 
 print(f"\nTraining set size: {X_train.shape}")
 print(f"Test set size: {X_test.shape}")
@@ -83,8 +80,11 @@ model = xgb.XGBClassifier(
     learning_rate=0.1,
     subsample=0.8,
     colsample_bytree=0.8,
+    tree_method='hist',  # histogram split finding instead of exact sorted scans
+    max_bin=256,
+    grow_policy='depthwise',
+    n_jobs=-1,
     random_state=42,
-    use_label_encoder=False,
     eval_metric='logloss',
 )
 
@@ -113,7 +113,19 @@ print(feature_importance)
 print("\nConverting to ONNX format...")
 initial_type = [('float_input', FloatTensorType([None, len(features_to_use)]))]
 
-onnx_model = skl2onnx.convert_sklearn(model, initial_types=initial_type, target_opset=12)
+# skl2onnx has no built-in XGBoost converter; register the one shipped with onnxmltools
+skl2onnx.update_registered_converter(
+    xgb.XGBClassifier,
+    'XGBoostXGBClassifier',
+    calculate_linear_classifier_output_shapes,
+    convert_xgboost,
+    options={'nocl': [True, False], 'zipmap': [True, False, 'columns']},
+)
+
+# The XGBoost converter emits TreeEnsemble nodes that skl2onnx only accepts at ai.onnx.ml 3
+onnx_model = skl2onnx.convert_sklearn(
+    model, initial_types=initial_type, target_opset={'': 19, 'ai.onnx.ml': 3}
+)
 
 # Save ONNX model
 output_path = 'public/models/heart_disease_model.onnx'